@@ -1,109 +1,235 @@
 import math
 import logging
 from datetime import datetime, timedelta
+import numpy as np
+from scipy.spatial import cKDTree
+from sqlalchemy import bindparam, exists, func, select, update
 from app import db
 from models import Ride, Driver
+from allocation_kernels import haversine_nb as haversine
 
 # Configuration constants
-SEARCH_EXPANSION_KM = 2  # Expand search radius by 2 km every 10 seconds
+SEARCH_EXPANSION_KM = 2  # Radius step used when reporting how far a match was found
 MAX_SEARCH_RADIUS_KM = 20  # Maximum search radius
+EARTH_RADIUS_KM = 6371
+KM_PER_DEG_LAT = 110.57
+KM_PER_DEG_LON = 111.32  # at the equator, scaled by cos(latitude) elsewhere
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def haversine(lat1, lon1, lat2, lon2):
-    """Calculate the great circle distance between two points on the earth"""
-    R = 6371  # Earth radius in km
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
-    return R * (2 * math.atan2(math.sqrt(a), math.sqrt(1-a)))
+# Available drivers as parallel arrays (structure of arrays), rebuilt on every allocation tick
+_drivers = {
+    'id': np.empty(0, dtype=np.int64),
+    'lat': np.empty(0, dtype=np.float64),
+    'lon': np.empty(0, dtype=np.float64),
+    'active': np.empty(0, dtype=bool),  # driver already has an active ride
+    'cancelled': np.empty(0, dtype=np.int64),
+}
+_driver_tree = None  # cKDTree over the drivers' unit-sphere coordinates
+
+def flat_dist(lat1, lon1, lat2, lon2, cos_lat0):
+    """Equirectangular approximation of the distance in km, accurate to <0.1% within a city"""
+    dx = (lon2 - lon1) * (KM_PER_DEG_LON * cos_lat0)
+    dy = (lat2 - lat1) * KM_PER_DEG_LAT
+    return np.hypot(dx, dy)
+
+def to_unit_xyz(lat, lon):
+    """Convert latitudes/longitudes in degrees to (N, 3) points on the unit sphere"""
+    phi = np.radians(np.atleast_1d(lat))
+    lam = np.radians(np.atleast_1d(lon))
+    cos_phi = np.cos(phi)
+    return np.column_stack((cos_phi * np.cos(lam), cos_phi * np.sin(lam), np.sin(phi)))
+
+def chord_length(radius_km):
+    """Straight-line distance on the unit sphere matching a great circle distance in km"""
+    return 2 * np.sin(radius_km / (2 * EARTH_RADIUS_KM))
+
+def load_available_drivers():
+    """Load all available drivers into the structure-of-arrays cache and index their locations"""
+    global _drivers, _driver_tree
+    rows = Driver.query.filter_by(available=True).with_entities(
+        Driver.id, Driver.latitude, Driver.longitude, Driver.active_ride_id, Driver.cancelled_rides_count
+    ).all()
+    _drivers = {
+        'id': np.array([row.id for row in rows], dtype=np.int64),
+        'lat': np.array([row.latitude for row in rows], dtype=np.float64),
+        'lon': np.array([row.longitude for row in rows], dtype=np.float64),
+        'active': np.array([bool(row.active_ride_id) for row in rows], dtype=bool),
+        'cancelled': np.array([row.cancelled_rides_count or 0 for row in rows], dtype=np.int64),
+    }
+    _driver_tree = cKDTree(to_unit_xyz(_drivers['lat'], _drivers['lon'])) if len(rows) else None
+    return _drivers
+
+def drivers_within(lat, lon, radius_km):
+    """Return the positions in the driver arrays of drivers within radius_km of a point"""
+    if _driver_tree is None:
+        return np.empty(0, dtype=np.intp)
+    idx = _driver_tree.query_ball_point(to_unit_xyz(lat, lon)[0], chord_length(radius_km))
+    return np.asarray(idx, dtype=np.intp)
+
+def search_radius_band(dist_km):
+    """Return the expanding-search radius step a driver at dist_km falls into"""
+    return max(1, math.ceil(dist_km / SEARCH_EXPANSION_KM)) * SEARCH_EXPANSION_KM
 
 def allocate_drivers():
     """Background job that scans unassigned rides and matches them with available drivers"""
     try:
-        # Get all unassigned rides in 'create_ride' state, ordered by creation time
-        rides = Ride.query.filter_by(status="create_ride").order_by(Ride.created_at).all()
-        logger.info(f"Found {len(rides)} unassigned rides")
+        # Stream unassigned rides in 'create_ride' state, ordered by creation time
+        rides = Ride.query.filter_by(status="create_ride").order_by(Ride.created_at).with_entities(
+            Ride.id, Ride.rider_id, Ride.pickup_lat, Ride.pickup_long
+        ).yield_per(500)
+
+        # Get all available drivers once per tick; assigned drivers are dropped as we go
+        drivers = load_available_drivers()
+        driver_ids = drivers['id']
+        available = np.ones(len(driver_ids), dtype=bool)
+        logger.info(f"Found {len(driver_ids)} available drivers")
+
+        # Rules 1 and 3 don't depend on the ride, so evaluate them once per tick
+        static_ok = ~drivers['active'] & (drivers['cancelled'] < 2)
+
+        # One clock read per tick, shared by the recency window and assignment timestamps
+        now = datetime.utcnow()
+
+        # Rule 2 inputs: (driver, rider) pairs with a ride completed in the last 30 minutes
+        thirty_min_ago = now - timedelta(minutes=30)
+        recent = db.session.execute(
+            select(Ride.driver_id, Ride.rider_id).where(
+                Ride.status == "end_ride",
+                Ride.end_ride_at > thirty_min_ago
+            )
+        ).all()
+        # Index them by rider as positions in the driver arrays
+        position = {driver_id: i for i, driver_id in enumerate(driver_ids.tolist())}
+        recent_by_rider = {}
+        for driver_id, rider_id in recent:
+            if driver_id in position:
+                recent_by_rider.setdefault(rider_id, []).append(position[driver_id])
         
+        rides_processed = 0
+        assignments = []  # (ride_id, driver_id, assigned_at), written in bulk after the loop
         for ride in rides:
-            logger.info(f"Processing ride {ride.id} - Pickup: ({ride.pickup_lat:.4f}, {ride.pickup_long:.4f}), Rider ID: {ride.rider_id}")
-            radius = SEARCH_EXPANSION_KM
-            assigned_driver = None
-
-            # Expand search radius until a match is found or max radius is reached
-            while radius <= MAX_SEARCH_RADIUS_KM and not assigned_driver:
-                # Get all available drivers
-                drivers = Driver.query.filter_by(available=True).all()
-                logger.info(f"Found {len(drivers)} available drivers for ride {ride.id} within {radius} km radius")
-                eligible_drivers = []
-                excluded_drivers = {"active_ride": 0, "recent_ride": 0, "cancelled_rides": 0, "out_of_range": 0}
-
-                for driver in drivers:
-                    # Rule 1: Driver must not be assigned to more than one active ride
-                    if driver.active_ride_id:
-                        logger.debug(f"Driver {driver.id} excluded: Already has active ride {driver.active_ride_id}")
-                        excluded_drivers["active_ride"] += 1
-                        continue
-
-                    # Rule 2: Exclude drivers who recently completed a ride with the same rider within 30 minutes
-                    thirty_min_ago = datetime.utcnow() - timedelta(minutes=30)
-                    recent_ride = Ride.query.filter(
-                        Ride.driver_id == driver.id,
-                        Ride.rider_id == ride.rider_id,
-                        Ride.status == "end_ride",
-                        Ride.end_ride_at > thirty_min_ago
-                    ).first()
-                    
-                    if recent_ride:
-                        logger.debug(f"Driver {driver.id} excluded: Recently completed ride {recent_ride.id} with rider {ride.rider_id}")
-                        excluded_drivers["recent_ride"] += 1
-                        continue
-
-                    # Rule 3: Exclude drivers who cancelled their last 2 rides
-                    if driver.cancelled_rides_count >= 2:
-                        logger.debug(f"Driver {driver.id} excluded: Has {driver.cancelled_rides_count} cancelled rides")
-                        excluded_drivers["cancelled_rides"] += 1
-                        continue
-
-                    # Check if driver is within the current search radius
-                    dist = haversine(ride.pickup_lat, ride.pickup_long, driver.latitude, driver.longitude)
-                    logger.debug(f"Driver {driver.id} is {dist:.2f} km away from pickup location")
-                    
-                    if dist <= radius:
-                        eligible_drivers.append((driver, dist))
-                        logger.debug(f"Driver {driver.id} is eligible at distance {dist:.2f} km")
-                    else:
-                        excluded_drivers["out_of_range"] += 1
+            rides_processed += 1
+            # A bad ride (e.g. missing coordinates) is logged and skipped so it can't
+            # roll back the tick's other assignments
+            try:
+                logger.info(f"Processing ride {ride.id} - Pickup: ({ride.pickup_lat:.4f}, {ride.pickup_long:.4f}), Rider ID: {ride.rider_id}")
+
+                # The closest eligible driver within the maximum radius is the one the
+                # expanding search would find first, so a single query is enough.
+                # Drivers assigned earlier in this tick are no longer available.
+                nearby_idx = drivers_within(ride.pickup_lat, ride.pickup_long, MAX_SEARCH_RADIUS_KM)
+                nearby_idx = nearby_idx[available[nearby_idx]]
+
+                # Rules are evaluated over every available driver in order, so each exclusion
+                # is counted under the first rule it fails and out_of_range only counts
+                # drivers that pass all rules but are beyond the radius.
+                # Rule 1: Driver must not be assigned to more than one active ride
+                has_active = available & drivers['active']
+                # Rule 2: Exclude drivers who recently completed a ride with the same rider within 30 minutes
+                recent_mask = np.zeros(len(driver_ids), dtype=bool)
+                recent_mask[recent_by_rider.get(ride.rider_id, [])] = True
+                recent_ride = available & ~drivers['active'] & recent_mask
+                # Rule 3: Exclude drivers who cancelled their last 2 rides
+                too_many_cancels = available & ~drivers['active'] & ~recent_mask & (drivers['cancelled'] >= 2)
+
+                rules_ok = available & static_ok & ~recent_mask
+                eligible_idx = nearby_idx[rules_ok[nearby_idx]]
+                # Rank by the cheap flat-earth distance; only the winner gets an exact great circle distance
+                cos_lat0 = math.cos(math.radians(ride.pickup_lat))
+                eligible_dists = flat_dist(ride.pickup_lat, ride.pickup_long, drivers['lat'][eligible_idx], drivers['lon'][eligible_idx], cos_lat0)
+
+                excluded_drivers = {
+                    "active_ride": int(np.count_nonzero(has_active)),
+                    "recent_ride": int(np.count_nonzero(recent_ride)),
+                    "cancelled_rides": int(np.count_nonzero(too_many_cancels)),
+                    "out_of_range": int(np.count_nonzero(rules_ok)) - len(eligible_idx),
+                }
 
                 # Log exclusion statistics
-                logger.info(f"Ride {ride.id} - Radius {radius} km - Exclusion stats: {excluded_drivers}")
-                logger.info(f"Ride {ride.id} - Found {len(eligible_drivers)} eligible drivers within {radius} km radius")
+                logger.info(f"Ride {ride.id} - Max radius {MAX_SEARCH_RADIUS_KM} km - Exclusion stats: {excluded_drivers}")
+                logger.info(f"Ride {ride.id} - Found {len(eligible_idx)} eligible drivers within {MAX_SEARCH_RADIUS_KM} km radius")
 
                 # If eligible drivers found, assign the closest one
-                if eligible_drivers:
-                    eligible_drivers.sort(key=lambda x: x[1])  # Sort by distance
-                    assigned_driver = eligible_drivers[0][0]
-                    logger.info(f"Selected closest driver {assigned_driver.id} at {eligible_drivers[0][1]:.2f} km for ride {ride.id}")
-                    break
-
-                # Expand search radius for next iteration
-                radius += SEARCH_EXPANSION_KM
-                logger.info(f"No eligible drivers found. Expanding search radius to {radius} km for ride {ride.id}")
-
-            # If a driver was found, update ride and driver status
-            if assigned_driver:
-                ride.driver_id = assigned_driver.id
-                ride.driver_assigned_at = datetime.utcnow()
-                ride.status = "driver_assigned"
-                assigned_driver.available = False
-                assigned_driver.active_ride_id = ride.id
-                db.session.commit()
-                logger.info(f"SUCCESS: Assigned driver {assigned_driver.id} to ride {ride.id} at distance {eligible_drivers[0][1]:.2f} km")
-            else:
-                logger.warning(f"FAILED: No eligible driver found for ride {ride.id} within maximum radius of {MAX_SEARCH_RADIUS_KM} km")
+                if len(eligible_idx):
+                    closest = int(np.argmin(eligible_dists))
+                    assigned_idx = eligible_idx[closest]
+                    assigned_dist = haversine(ride.pickup_lat, ride.pickup_long,
+                                              drivers['lat'][assigned_idx], drivers['lon'][assigned_idx])
+                    assigned_driver_id = int(driver_ids[assigned_idx])
+                    logger.info(f"Selected closest driver {assigned_driver_id} at {assigned_dist:.2f} km "
+                                f"(within {search_radius_band(assigned_dist)} km radius) for ride {ride.id}")
+
+                    # Record the assignment; ride and driver rows are updated in bulk after the loop
+                    assignments.append((ride.id, assigned_driver_id, now))
+                    available[assigned_idx] = False
+                    logger.info(f"SUCCESS: Assigned driver {assigned_driver_id} to ride {ride.id} at distance {assigned_dist:.2f} km")
+                else:
+                    logger.warning(f"FAILED: No eligible driver found for ride {ride.id} within maximum radius of {MAX_SEARCH_RADIUS_KM} km")
+            except Exception as e:
+                logger.error(f"Error allocating ride {ride.id}, skipping it: {str(e)}")
+
+        # Apply all assignments with executemany UPDATEs and a single commit. Rides and
+        # drivers may have changed since they were read (e.g. another allocation run),
+        # so every write is guarded and only lands if both sides are still free.
+        assigned = 0
+        if assignments:
+            rides_table, drivers_table = Ride.__table__, Driver.__table__
+            params = [{"rid": ride_id, "did": driver_id, "ts": ts} for ride_id, driver_id, ts in assignments]
+            # Claim drivers that are still available
+            db.session.execute(
+                update(drivers_table).where(
+                    drivers_table.c.id == bindparam("did"),
+                    drivers_table.c.available == True
+                ).values(
+                    available=False,
+                    active_ride_id=bindparam("rid")
+                ),
+                params
+            )
+            # Assign rides that are still unassigned, to drivers this tick actually claimed
+            db.session.execute(
+                update(rides_table).where(
+                    rides_table.c.id == bindparam("rid"),
+                    rides_table.c.status == "create_ride",
+                    exists().where(
+                        drivers_table.c.id == bindparam("did"),
+                        drivers_table.c.active_ride_id == bindparam("rid")
+                    )
+                ).values(
+                    driver_id=bindparam("did"),
+                    driver_assigned_at=bindparam("ts"),
+                    status="driver_assigned"
+                ),
+                params
+            )
+            # Release claimed drivers whose ride was taken elsewhere in the meantime
+            db.session.execute(
+                update(drivers_table).where(
+                    drivers_table.c.id == bindparam("did"),
+                    drivers_table.c.active_ride_id == bindparam("rid"),
+                    ~exists().where(
+                        rides_table.c.id == bindparam("rid"),
+                        rides_table.c.driver_id == bindparam("did")
+                    )
+                ).values(
+                    available=True,
+                    active_ride_id=None
+                ),
+                params
+            )
+            assigned = db.session.execute(
+                select(func.count()).select_from(rides_table).where(
+                    rides_table.c.id.in_([ride_id for ride_id, _, _ in assignments]),
+                    rides_table.c.driver_assigned_at == now
+                )
+            ).scalar()
+            if assigned < len(assignments):
+                logger.warning(f"{len(assignments) - assigned} assignments skipped: ride or driver changed during the tick")
+        db.session.commit()
+        logger.info(f"Processed {rides_processed} unassigned rides, assigned {assigned}")
     
     except Exception as e:
         logger.error(f"Error in driver allocation: {str(e)}")
@@ -0,0 +1,50 @@
+import math
+from numba import njit, prange, vectorize
+
+_DEG2RAD = 0.017453292519943295  # math.pi / 180
+
+@njit('f8(f8,f8,f8,f8)', cache=True, fastmath=True)
+def haversine_nb(lat1, lon1, lat2, lon2):
+    """Calculate the great circle distance between two points on the earth"""
+    R = 6371.0  # Earth radius in km
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
+    return R * (2 * math.atan2(math.sqrt(a), math.sqrt(1-a)))
+
+@vectorize(['f8(f8,f8,f8,f8)'], fastmath=True, target='parallel')
+def haversine_ufunc(lat1, lon1, lat2, lon2):
+    """Element-wise great circle distance, broadcasting scalars against arrays"""
+    return haversine_nb(lat1, lon1, lat2, lon2)
+
+@njit(fastmath=True, cache=True)
+def fare_haversine_nb(lat1, lon1, lat2, lon2):
+    """Great circle distance for fares, with shortcuts for identical and nearby points"""
+    R = 6371  # Earth radius in km
+    if lat1 == lat2 and lon1 == lon2:
+        return 0.0
+    # Within ~22 km the equirectangular approximation is within about half a metre
+    if abs(lat2 - lat1) < 0.2 and abs(lon2 - lon1) < 0.2:
+        x = (lon2 - lon1) * _DEG2RAD * math.cos((lat1 + lat2) * 0.5 * _DEG2RAD)
+        y = (lat2 - lat1) * _DEG2RAD
+        return R * math.hypot(x, y)
+    phi1, phi2 = lat1 * _DEG2RAD, lat2 * _DEG2RAD
+    dphi = (lat2 - lat1) * _DEG2RAD
+    dlambda = (lon2 - lon1) * _DEG2RAD
+    s1 = math.sin(dphi * 0.5)
+    s2 = math.sin(dlambda * 0.5)
+    a = s1 * s1 + math.cos(phi1) * math.cos(phi2) * s2 * s2
+    # asin form: one sqrt and no atan2; clamp guards against rounding past 1 near antipodes
+    return 2 * R * math.asin(math.sqrt(min(1.0, a)))
+
+@njit(parallel=True, fastmath=True, cache=True)
+def fare_haversine_par(lat1, lon1, lat2, lon2, out):
+    """Fare distances for arrays of point pairs, written into out across all cores"""
+    for i in prange(lat1.shape[0]):
+        out[i] = fare_haversine_nb(lat1[i], lon1[i], lat2[i], lon2[i])
+    return out
+
+# Warm up the kernels at import so the first allocation tick or fare doesn't pay for it
+haversine_nb(0.0, 0.0, 0.0, 0.0)
+fare_haversine_nb(0.0, 0.0, 0.0, 0.0)
@@ -1,24 +1,60 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ProcessPoolExecutor
 import atexit
+import logging
+import multiprocessing
+import sqlite3
 
 db = SQLAlchemy()
 scheduler = None
+_job_app = None  # app whose context the allocation job runs in, one per process
 
-def create_app(config_class='config.Config'):
+def run_allocation(config_class):
+    """Scheduler job: run one allocation tick inside an application context"""
+    global _job_app
+    # Pool worker processes build their own app (and engine) on their first tick
+    if _job_app is None:
+        _job_app = create_app(config_class, start_scheduler=False)
+    from allocation import allocate_drivers
+    with _job_app.app_context():
+        allocate_drivers()
+
+def create_app(config_class='config.Config', start_scheduler=True):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
     db.init_app(app)
     
     with app.app_context():
-        from allocation import allocate_drivers
+        from pricing import load_pricing
+
+        # Warm the pricing cache; before init_db the table doesn't exist yet and
+        # rates are loaded on first use instead
+        try:
+            load_pricing()
+        except SQLAlchemyError:
+            db.session.rollback()
+        except (sqlite3.Error, OSError) as e:
+            # A broken on-disk rate snapshot mustn't stop the app; rates load on first use
+            logging.getLogger(__name__).warning(f"Pricing disk cache unavailable: {str(e)}")
         
-        global scheduler
-        if not scheduler:
-            scheduler = BackgroundScheduler()
-            scheduler.add_job(func=lambda: allocate_drivers(), trigger="interval", seconds=10)
+        global scheduler, _job_app
+        # Allocation pool workers are spawned and re-import __main__, which calls
+        # create_app() again; only the parent process may own the scheduler
+        if start_scheduler and not scheduler and multiprocessing.current_process().name == "MainProcess":
+            workers = app.config.get("ALLOCATION_WORKERS", 0)
+            if workers:
+                # Allocate on worker processes so ticks don't compete with requests for the GIL
+                scheduler = BackgroundScheduler(executors={'default': ProcessPoolExecutor(workers)})
+            else:
+                scheduler = BackgroundScheduler()
+                _job_app = app
+            # Never run two ticks at once; a late tick is merged into one run or skipped
+            scheduler.add_job(run_allocation, trigger="interval", seconds=10, args=[config_class],
+                              id='alloc', max_instances=1, coalesce=True, misfire_grace_time=5)
             scheduler.start()
             # Shut down the scheduler when exiting the app
             atexit.register(lambda: scheduler.shutdown())
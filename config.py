@@ -8,3 +8,19 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY", "defaultsecret")
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Keep pooled connections healthy for the 10-second allocation job
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    # SQLite doesn't use a sized connection pool
+    if not (SQLALCHEMY_DATABASE_URI or "").startswith("sqlite"):
+        SQLALCHEMY_ENGINE_OPTIONS.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        )
+    # Worker processes for the allocation job; 0 runs it on a thread in this process
+    ALLOCATION_WORKERS = int(os.getenv("ALLOCATION_WORKERS", 0))
+    # Private directory for the on-disk pricing rate snapshot (needs diskcache); unset disables it.
+    # diskcache unpickles what it reads, so don't point this at a shared location such as /tmp
+    PRICING_CACHE_DIR = os.getenv("PRICING_CACHE_DIR", "")
\ No newline at end of file
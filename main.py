@@ -13,6 +13,9 @@ Commands:
   - Run server (Flask admin endpoints to inspect DB):
       python main.py runserver
 
+  - Recompute stored fares for all completed rides with current pricing:
+      python main.py recompute_fares
+
 Ride Lifecycle:
   - create_ride: A ride request is created with pickup and drop coordinates
   - driver_assigned: A nearby driver is automatically assigned
@@ -27,9 +30,12 @@ import time
 import random
 import logging
 from datetime import datetime, timedelta
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from faker import Faker
-from utils import haversine
+import numpy as np
+from sqlalchemy import func, select
+import orjson
+from allocation_kernels import haversine_ufunc
 
 # Set up logging
 logging.basicConfig(
@@ -51,25 +57,36 @@ faker = Faker()
 
 from app import create_app, db
 from models import Rider, Driver, Ride, PricingConfig
-from pricing import calculate_fare
+from pricing import calculate_fare, invalidate_rates, load_pricing, recompute_fares
 from allocation import allocate_drivers
 
 # Create Flask application
 app = create_app()
 
 # ---------------- HELPERS ----------------
-def random_point_within_km(center, radius_km):
-    """Generate a random point within a given radius from a center point"""
-    import math
-    # Approximate random point within radius using simple offset
+def random_points_within_km(center, radius_km, n):
+    """Generate n random points within a given radius from a center point
+
+    center is a (lat, lng) pair; each coordinate may also be an array of n values
+    to give every point its own center. Returns an (n, 2) array of (lat, lng).
+    """
+    # Approximate random points within radius using simple offsets
     # 1 deg lat ~ 111 km; 1 deg lon ~ 111 km * cos(lat)
-    r = random.random()**0.5 * radius_km
-    theta = random.random() * 2 * math.pi
-    dx = r * math.cos(theta)
-    dy = r * math.sin(theta)
+    center_lat = np.asarray(center[0], dtype=np.float64)
+    center_lng = np.asarray(center[1], dtype=np.float64)
+    r = np.sqrt(np.random.random(n)) * radius_km
+    theta = np.random.random(n) * 2 * np.pi
+    dx = r * np.cos(theta)
+    dy = r * np.sin(theta)
     dlat = dy / 111.0
-    dlng = dx / (111.0 * math.cos(math.radians(center[0])))
-    return (center[0] + dlat, center[1] + dlng)
+    dlng = dx / (111.0 * np.cos(np.radians(center_lat)))
+    return np.column_stack([center_lat + dlat, center_lng + dlng])
+
+def minutes_between(start, end):
+    """SQL expression for the minutes elapsed between two datetime columns"""
+    if db.engine.dialect.name == "sqlite":
+        return (func.julianday(end) - func.julianday(start)) * 1440
+    return func.extract("epoch", end - start) / 60
 
 # ---------------- SIMULATION FUNCTIONS ----------------
 def seed_pricing():
@@ -86,6 +103,7 @@ def seed_pricing():
             for k, v in rates.items():
                 db.session.add(PricingConfig(key=k, value=str(v)))
             db.session.commit()
+            load_pricing()
             logger.info("Pricing configuration seeded")
         else:
             logger.info("Pricing configuration already exists")
@@ -99,17 +117,20 @@ def seed_users():
             return
             
         # Create 10 riders
-        for i in range(NUM_RIDERS):
-            lat, lng = random_point_within_km(CITY_CENTER, CITY_RADIUS_KM)
-            r = Rider(name=f"Rider{i+1}", latitude=lat, longitude=lng)
-            db.session.add(r)
+        riders = [
+            {"name": f"Rider{i+1}", "latitude": lat, "longitude": lng}
+            for i, (lat, lng) in enumerate(random_points_within_km(CITY_CENTER, CITY_RADIUS_KM, NUM_RIDERS).tolist())
+        ]
 
         # Create 15 drivers
-        for i in range(NUM_DRIVERS):
-            lat, lng = random_point_within_km(CITY_CENTER, CITY_RADIUS_KM)
-            d = Driver(name=f"Driver{i+1}", latitude=lat, longitude=lng, available=True)
-            db.session.add(d)
-            
+        drivers = [
+            {"name": f"Driver{i+1}", "latitude": lat, "longitude": lng, "available": True}
+            for i, (lat, lng) in enumerate(random_points_within_km(CITY_CENTER, CITY_RADIUS_KM, NUM_DRIVERS).tolist())
+        ]
+
+        # Insert each table with a single executemany
+        db.session.execute(Rider.__table__.insert(), riders)
+        db.session.execute(Driver.__table__.insert(), drivers)
         db.session.commit()
         logger.info(f"Created {NUM_RIDERS} riders and {NUM_DRIVERS} drivers")
 
@@ -185,47 +206,53 @@ def generate_rides(days=SIM_DAYS):
         
         riders = Rider.query.all()
         logger.info(f"Found {len(riders)} riders for ride generation")
+        rider_ids = np.array([rider.id for rider in riders], dtype=np.int64)
+        rider_lat = np.array([rider.latitude for rider in riders], dtype=np.float64)
+        rider_lng = np.array([rider.longitude for rider in riders], dtype=np.float64)
         
         total_rides_generated = 0
         rides_by_day = {}
         
         for day in range(days):
-            day_rides = 0
             logger.info(f"\n----- GENERATING RIDES FOR DAY {day+1} -----")
             
-            for rider_index, rider in enumerate(riders, 1):
-                # Each rider generates 1-2 ride requests per day
-                num_requests = random.randint(1, 2)
-                
-                for req in range(num_requests):
-                    # Generate random pickup and drop locations
-                    pickup = random_point_within_km((rider.latitude, rider.longitude), 5)
-                    drop = random_point_within_km((rider.latitude, rider.longitude), 10)
-                    
-                    # Calculate straight-line distance between pickup and drop
-                    distance = haversine(pickup[0], pickup[1], drop[0], drop[1])
-                    
-                    # Create ride request with random time during the day
-                    created_time = datetime.utcnow() + timedelta(days=day, seconds=random.randint(0, 86400))
-                    
-                    ride = Ride(
-                        rider_id=rider.id,
-                        pickup_lat=pickup[0],
-                        pickup_long=pickup[1],
-                        drop_lat=drop[0],
-                        drop_long=drop[1],
-                        status="create_ride",
-                        created_at=created_time,
-                        distance_km=round(distance, 2)  # Pre-calculate the distance
-                    )
-                    db.session.add(ride)
-                    
-                    day_rides += 1
-                    
-                    # Log every 10th ride for performance reasons
-                    if (day_rides % 10 == 0) or (rider_index == len(riders) and req == num_requests - 1):
-                        logger.info(f"Generated {day_rides} rides for day {day+1} so far")
+            # Each rider generates 1-2 ride requests per day
+            requests_per_rider = np.random.randint(1, 3, size=len(riders))
+            ride_rider_idx = np.repeat(np.arange(len(riders)), requests_per_rider)
+            day_rides = len(ride_rider_idx)
+            centers = (rider_lat[ride_rider_idx], rider_lng[ride_rider_idx])
+
+            # Generate random pickup and drop locations for the whole day at once
+            pickups = random_points_within_km(centers, 5, day_rides)
+            drops = random_points_within_km(centers, 10, day_rides)
+
+            # Calculate straight-line distance between pickup and drop
+            distances = haversine_ufunc(pickups[:, 0], pickups[:, 1], drops[:, 0], drops[:, 1])
+
+            # Create ride requests with random times during the day
+            day_start = datetime.utcnow() + timedelta(days=day)
+            offsets = np.random.randint(0, 86401, size=day_rides)
+
+            rides_buffer = [
+                {
+                    "rider_id": rider_id,
+                    "pickup_lat": pickup_lat,
+                    "pickup_long": pickup_long,
+                    "drop_lat": drop_lat,
+                    "drop_long": drop_long,
+                    "status": "create_ride",
+                    "created_at": day_start + timedelta(seconds=offset),
+                    "distance_km": round(distance, 2)  # Pre-calculate the distance
+                }
+                for rider_id, (pickup_lat, pickup_long), (drop_lat, drop_long), distance, offset in zip(
+                    rider_ids[ride_rider_idx].tolist(), pickups.tolist(), drops.tolist(),
+                    distances.tolist(), offsets.tolist()
+                )
+            ]
             
+            # Insert the whole day with a single executemany
+            if rides_buffer:
+                db.session.execute(Ride.__table__.insert(), rides_buffer)
             db.session.commit()
             total_rides_generated += day_rides
             rides_by_day[day+1] = day_rides
@@ -286,41 +313,32 @@ def simulate_rides():
 def generate_summary():
     """Generate and display summary metrics for the simulation"""
     with app.app_context():
-        from sqlalchemy import func
-        
         total_rides = Ride.query.count()
         completed_rides = Ride.query.filter_by(status="end_ride").count()
         unmatched_rides = Ride.query.filter_by(status="create_ride").count()
         cancelled_rides = Ride.query.filter_by(status="cancelled").count() if hasattr(Ride, 'cancelled') else 0
         
-        # Driver statistics
+        # Driver statistics, including per-driver averages, in a single aggregation
         driver_stats = db.session.query(
             Driver.id,
             Driver.name,
+            Driver.cancelled_rides_count,
             func.count(Ride.id).label("rides_count"),
             func.sum(Ride.fare).label("total_fare"),
-            func.avg(Ride.fare).label("avg_fare")
+            func.avg(Ride.fare).label("avg_fare"),
+            func.avg(minutes_between(Ride.driver_at_location_at, Ride.start_ride_at)).label("avg_wait"),
+            func.avg(minutes_between(Ride.start_ride_at, Ride.end_ride_at)).label("avg_duration")
         ).outerjoin(
             Ride, (Ride.driver_id == Driver.id) & (Ride.status == "end_ride")
         ).group_by(Driver.id).order_by(Driver.id).all()
         
-        # Calculate global average wait time and ride duration
-        completed_rides_data = Ride.query.filter_by(status="end_ride").all()
-
-        wait_times = []
-        ride_durations = []
-
-        for ride in completed_rides_data:
-            if ride.driver_at_location_at and ride.start_ride_at:
-                wait_time = (ride.start_ride_at - ride.driver_at_location_at).total_seconds() / 60
-                wait_times.append(wait_time)
-            
-            if ride.start_ride_at and ride.end_ride_at:
-                duration = (ride.end_ride_at - ride.start_ride_at).total_seconds() / 60
-                ride_durations.append(duration)
-
-        avg_wait_time = sum(wait_times) / len(wait_times) if wait_times else 0
-        avg_ride_duration = sum(ride_durations) / len(ride_durations) if ride_durations else 0
+        # Calculate global average wait time and ride duration in the database
+        avg_wait_time, avg_ride_duration = db.session.query(
+            func.avg(minutes_between(Ride.driver_at_location_at, Ride.start_ride_at)),
+            func.avg(minutes_between(Ride.start_ride_at, Ride.end_ride_at))
+        ).filter(Ride.status == "end_ride").one()
+        avg_wait_time = float(avg_wait_time or 0)
+        avg_ride_duration = float(avg_ride_duration or 0)
                 
         # Print summary
         logger.info("\n=== SIMULATION SUMMARY ===")
@@ -333,23 +351,10 @@ def generate_summary():
         
         logger.info("\n--- DRIVER STATISTICS ---")
         for stat in driver_stats:
-            driver_id, name, rides_count, total_fare, avg_fare = stat
-            driver = Driver.query.get(driver_id)
-            cancelled = driver.cancelled_rides_count if driver else 0
-            
-            # Calculate per-driver averages
-            driver_rides = Ride.query.filter_by(driver_id=driver_id, status="end_ride").all()
-            driver_wait_times = [
-                (r.start_ride_at - r.driver_at_location_at).total_seconds() / 60
-                for r in driver_rides if r.driver_at_location_at and r.start_ride_at
-            ]
-            driver_durations = [
-                (r.end_ride_at - r.start_ride_at).total_seconds() / 60
-                for r in driver_rides if r.start_ride_at and r.end_ride_at
-            ]
-            
-            avg_driver_wait = sum(driver_wait_times) / len(driver_wait_times) if driver_wait_times else 0
-            avg_driver_duration = sum(driver_durations) / len(driver_durations) if driver_durations else 0
+            driver_id, name, cancelled, rides_count, total_fare, avg_fare, avg_driver_wait, avg_driver_duration = stat
+            cancelled = cancelled or 0
+            avg_driver_wait = float(avg_driver_wait or 0)
+            avg_driver_duration = float(avg_driver_duration or 0)
         
             if rides_count > 0:
                 logger.info(f"Driver {driver_id} ({name}):")
@@ -374,75 +379,96 @@ def generate_summary():
 def health():
     return jsonify({'status': 'ok'})
 
+def json_response(data):
+    """Serialize with orjson; naive datetimes are written as ISO 8601 like isoformat()"""
+    return Response(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY), mimetype='application/json')
+
 @app.route('/api/rides')
 def list_rides():
     with app.app_context():
-        rides = Ride.query.all()
-        result = []
-        for ride in rides:
-            result.append({
-                'id': ride.id,
-                'rider_id': ride.rider_id,
-                'driver_id': ride.driver_id,
-                'status': ride.status,
-                'pickup_location': (ride.pickup_lat, ride.pickup_long),
-                'drop_location': (ride.drop_lat, ride.drop_long),
-                'created_at': ride.created_at.isoformat() if ride.created_at else None,
-                'driver_assigned_at': ride.driver_assigned_at.isoformat() if ride.driver_assigned_at else None,
-                'driver_at_location_at': ride.driver_at_location_at.isoformat() if ride.driver_at_location_at else None,
-                'start_ride_at': ride.start_ride_at.isoformat() if ride.start_ride_at else None,
-                'end_ride_at': ride.end_ride_at.isoformat() if ride.end_ride_at else None,
-                'distance_km': ride.distance_km,
-                'fare': ride.fare
-            })
-        return jsonify(result)
+        rows = db.session.execute(select(
+            Ride.id, Ride.rider_id, Ride.driver_id, Ride.status,
+            Ride.pickup_lat, Ride.pickup_long, Ride.drop_lat, Ride.drop_long,
+            Ride.created_at, Ride.driver_assigned_at, Ride.driver_at_location_at,
+            Ride.start_ride_at, Ride.end_ride_at, Ride.distance_km, Ride.fare
+        )).tuples()
+        # Unpack each row positionally into a constant-key dict literal; no per-field attribute lookups
+        return json_response([{
+            'id': id_,
+            'rider_id': rider_id,
+            'driver_id': driver_id,
+            'status': status,
+            'pickup_location': (pickup_lat, pickup_long),
+            'drop_location': (drop_lat, drop_long),
+            'created_at': created_at,
+            'driver_assigned_at': driver_assigned_at,
+            'driver_at_location_at': driver_at_location_at,
+            'start_ride_at': start_ride_at,
+            'end_ride_at': end_ride_at,
+            'distance_km': distance_km,
+            'fare': fare
+        } for (id_, rider_id, driver_id, status, pickup_lat, pickup_long, drop_lat, drop_long,
+               created_at, driver_assigned_at, driver_at_location_at, start_ride_at, end_ride_at,
+               distance_km, fare) in rows])
 
 @app.route('/api/drivers')
 def list_drivers():
     with app.app_context():
-        drivers = Driver.query.all()
-        result = []
-        for driver in drivers:
-            result.append({
-                'id': driver.id,
-                'name': driver.name,
-                'location': (driver.latitude, driver.longitude),
-                'available': driver.available,
-                'active_ride_id': driver.active_ride_id,
-                'cancelled_rides_count': driver.cancelled_rides_count
-            })
-        return jsonify(result)
+        rows = db.session.execute(select(
+            Driver.id, Driver.name, Driver.latitude, Driver.longitude,
+            Driver.available, Driver.active_ride_id, Driver.cancelled_rides_count
+        )).tuples()
+        return json_response([{
+            'id': id_,
+            'name': name,
+            'location': (latitude, longitude),
+            'available': available,
+            'active_ride_id': active_ride_id,
+            'cancelled_rides_count': cancelled_rides_count
+        } for (id_, name, latitude, longitude, available, active_ride_id, cancelled_rides_count) in rows])
 
 @app.route('/api/riders')
 def list_riders():
     with app.app_context():
-        riders = Rider.query.all()
-        result = []
-        for rider in riders:
-            result.append({
-                'id': rider.id,
-                'name': rider.name,
-                'location': (rider.latitude, rider.longitude)
-            })
-        return jsonify(result)
+        rows = db.session.execute(select(Rider.id, Rider.name, Rider.latitude, Rider.longitude)).tuples()
+        return json_response([{
+            'id': id_,
+            'name': name,
+            'location': (latitude, longitude)
+        } for (id_, name, latitude, longitude) in rows])
 
 @app.route('/api/metrics')
 def get_metrics():
     with app.app_context():
         return jsonify(generate_summary())
 
+@app.route('/api/pricing/reload', methods=['POST'])
+def reload_pricing():
+    """Reload cached pricing rates after PricingConfig has been changed"""
+    with app.app_context():
+        invalidate_rates()
+        return jsonify(load_pricing())
+
 # ---------------- CLI ENTRYPOINT ----------------
+def create_tables():
+    """Create missing tables, and missing indexes on tables that already exist"""
+    db.create_all()
+    # create_all() skips existing tables entirely, so add any indexes they lack
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
 def init_db():
     """Initialize the database tables"""
     with app.app_context():
-        db.create_all()
+        create_tables()
         logger.info("Database initialized")
 
 def run_simulation():
     """Run the complete simulation"""
     with app.app_context():
         # Initialize database
-        db.create_all()
+        create_tables()
         
         # Seed initial data
         seed_pricing()
@@ -456,18 +482,24 @@ def run_simulation():
         
         logger.info("Simulation completed successfully")
 
+def run_fare_recompute():
+    """Recompute and store fares for all completed rides"""
+    with app.app_context():
+        count = recompute_fares()
+        logger.info(f"Recomputed fares for {count} completed rides")
+
 def run_server():
     """Run the Flask server"""
     # Make sure database is initialized
     with app.app_context():
-        db.create_all()
+        create_tables()
     
     # Run the Flask application
     app.run(debug=True, host='0.0.0.0', port=5000)
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print("Usage: python main.py [init_db|simulate|runserver]")
+        print("Usage: python main.py [init_db|simulate|runserver|recompute_fares]")
         sys.exit(1)
     
     command = sys.argv[1]
@@ -478,6 +510,8 @@ if __name__ == '__main__':
         run_simulation()
     elif command == 'runserver':
         run_server()
+    elif command == 'recompute_fares':
+        run_fare_recompute()
     else:
-        print("Unknown command. Available commands: init_db, simulate, runserver")
+        print("Unknown command. Available commands: init_db, simulate, runserver, recompute_fares")
         sys.exit(1)
@@ -15,26 +15,32 @@ class Driver(db.Model):
     name = db.Column(db.String(100))
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
-    available = db.Column(db.Boolean, default=True)
+    available = db.Column(db.Boolean, default=True, index=True)
     active_ride_id = db.Column(db.Integer, nullable=True)
     cancelled_rides_count = db.Column(db.Integer, default=0)
     last_ride_end_time = db.Column(db.DateTime)
 
 class Ride(db.Model):
     __tablename__ = 'rides'
+    __table_args__ = (
+        # Unassigned rides are scanned by status in creation order
+        db.Index('ix_ride_status_created', 'status', 'created_at'),
+        # Covers the allocator's "recent ride with the same rider" lookup
+        db.Index('ix_ride_recent_driver_rider', 'status', 'end_ride_at', 'driver_id', 'rider_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     rider_id = db.Column(db.Integer, db.ForeignKey('riders.id'), nullable=False)
-    driver_id = db.Column(db.Integer, db.ForeignKey('drivers.id'), nullable=True)
+    driver_id = db.Column(db.Integer, db.ForeignKey('drivers.id'), nullable=True, index=True)
     pickup_lat = db.Column(db.Float)
     pickup_long = db.Column(db.Float)
     drop_lat = db.Column(db.Float)
     drop_long = db.Column(db.Float)
     status = db.Column(db.String(50), default="create_ride")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     driver_assigned_at = db.Column(db.DateTime)
     driver_at_location_at = db.Column(db.DateTime)
     start_ride_at = db.Column(db.DateTime)
-    end_ride_at = db.Column(db.DateTime)
+    end_ride_at = db.Column(db.DateTime, index=True)
     distance_km = db.Column(db.Float, default=0.0)  # Added to store ride distance
     fare = db.Column(db.Float, default=0.0)
 
@@ -1,87 +1,267 @@
-import math
+import logging
+import time
+import numpy as np
 from datetime import datetime
-from models import PricingConfig
+from flask import current_app
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from models import Ride, PricingConfig
 from app import db
+from allocation_kernels import fare_haversine_nb as haversine, fare_haversine_par as haversine_par
 
-def haversine(lat1, lon1, lat2, lon2):
-    """Calculate the great circle distance between two points on the earth"""
-    R = 6371  # Earth radius in km
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
-    return R * (2 * math.atan2(math.sqrt(a), math.sqrt(1-a)))
+logger = logging.getLogger(__name__)
+
+try:
+    import diskcache
+except ImportError:  # the on-disk rate cache is optional
+    diskcache = None
+
+# Fallback rates used when a key is missing from the key-value store
+DEFAULT_RATES = {
+    "base_fare": 20,
+    "rate_per_km": 10,
+    "rate_per_minute": 2,
+    "waiting_charge_per_minute": 1,
+}
+
+# Pricing rates from the key-value store as key -> (value, expires_at), refreshed after a TTL
+RATE_CACHE_TTL_S = 60
+_rate_cache = {}
+
+# Optional on-disk snapshot of the rates from the last successful load_pricing(). It is
+# only read when the database can't be reached at startup, so a cold process can still
+# price; normal lookups always go to PricingConfig once the in-memory TTL runs out.
+_disk = None
+
+def _disk_cache():
+    """Open the on-disk rate cache at PRICING_CACHE_DIR, or None when it's disabled"""
+    global _disk
+    if _disk is None and diskcache is not None:
+        directory = current_app.config.get("PRICING_CACHE_DIR")
+        if directory:
+            _disk = diskcache.Cache(directory)
+    return _disk
+
+def _cache_rates(rates):
+    """Replace the in-process cache with rates, all expiring after the TTL"""
+    expires_at = time.monotonic() + RATE_CACHE_TTL_S
+    _rate_cache.clear()
+    _rate_cache.update((key, (value, expires_at)) for key, value in rates.items())
+
+def load_pricing():
+    """Load all pricing rates into the in-process cache, replacing what was there"""
+    cache = _disk_cache()
+    try:
+        rates = {row.key: float(row.value) for row in PricingConfig.query.all()}
+    except SQLAlchemyError:
+        # Database unreachable: fall back to the last snapshot on disk, if there is one
+        rates = cache.get("rates") if cache is not None else None
+        if rates is None:
+            raise
+        db.session.rollback()
+        logger.warning("Pricing database unavailable, using %d rates from the disk snapshot", len(rates))
+        _cache_rates(rates)
+        return rates
+    _cache_rates(rates)
+    if cache is not None:
+        cache.set("rates", rates)
+    return rates
+
+def invalidate_rates():
+    """Drop cached pricing rates so the next lookup reads PricingConfig again"""
+    _rate_cache.clear()
+    cache = _disk_cache()
+    if cache is not None:
+        cache.delete("rates")
+
+def get_rates(keys, defaults):
+    """Get several pricing rates at once, fetching any that are missing or stale in a single query"""
+    now = time.monotonic()
+    rates = {}
+    missing = []
+    for key in keys:
+        cached = _rate_cache.get(key)
+        if cached and cached[1] > now:
+            rates[key] = cached[0]
+        else:
+            missing.append(key)
+    if missing:
+        rows = PricingConfig.query.with_entities(PricingConfig.key, PricingConfig.value).filter(
+            PricingConfig.key.in_(missing)
+        ).all()
+        expires_at = now + RATE_CACHE_TTL_S
+        for key, value in rows:
+            rates[key] = float(value)
+            _rate_cache[key] = (rates[key], expires_at)
+        # Keys absent from PricingConfig are cached with their default too, so a
+        # missing row doesn't send every lookup back to the database
+        for key in missing:
+            if key not in rates:
+                rates[key] = defaults.get(key, 0)
+                _rate_cache[key] = (rates[key], expires_at)
+    return rates
+
+def to_cents(amount):
+    """Convert a currency amount to whole cents"""
+    return round(amount * 100)
 
 def get_rate(key, default=0):
-    """Get pricing rate from the key-value store"""
-    config = PricingConfig.query.filter_by(key=key).first()
-    return float(config.value) if config else default
-
-def calculate_fare(ride):
-    """Calculate fare based on ride details"""
-    import logging
-    logger = logging.getLogger(__name__)
-    
-    logger.info(f"===== CALCULATING FARE FOR RIDE {ride.id} =====")
+    """Get pricing rate from the cached key-value store"""
+    return get_rates([key], {key: default})[key]
+
+def _set_if_changed(obj, attr, value):
+    """Assign only when the value differs, so an unchanged ride isn't marked dirty"""
+    if getattr(obj, attr, None) != value:
+        setattr(obj, attr, value)
+
+def calculate_fare(ride, commit=True):
+    """Calculate fare based on ride details; batch callers pass commit=False and commit once"""
+    # Read each instrumented attribute once; ride.* is only touched again to store results
+    rid = ride.id
+    distance_km = ride.distance_km
+    start = ride.start_ride_at
+    end = ride.end_ride_at
+    arrived = ride.driver_at_location_at
+
+    logger.info("===== CALCULATING FARE FOR RIDE %s =====", rid)
     
-    # Get rates from key-value store
-    base_fare = get_rate("base_fare", 20)
-    rate_per_km = get_rate("rate_per_km", 10)
-    rate_per_minute = get_rate("rate_per_minute", 2)
-    waiting_charge_per_minute = get_rate("waiting_charge_per_minute", 1)
+    # Get rates from key-value store in one lookup
+    rates = get_rates(DEFAULT_RATES.keys(), DEFAULT_RATES)
+    base_fare = rates["base_fare"]
+    rate_per_km = rates["rate_per_km"]
+    rate_per_minute = rates["rate_per_minute"]
+    waiting_charge_per_minute = rates["waiting_charge_per_minute"]
     
-    logger.info(f"Ride {ride.id} - Pricing rates: Base=${base_fare}, Per km=${rate_per_km}, Per min=${rate_per_minute}, Waiting=${waiting_charge_per_minute}/min")
+    logger.info("Ride %s - Pricing rates: Base=$%s, Per km=$%s, Per min=$%s, Waiting=$%s/min",
+                rid, base_fare, rate_per_km, rate_per_minute, waiting_charge_per_minute)
 
     # Calculate distance if not already set
-    if not ride.distance_km or ride.distance_km == 0:
-        ride.distance_km = haversine(
+    if not distance_km:
+        distance_km = haversine(
             ride.pickup_lat, ride.pickup_long, 
             ride.drop_lat, ride.drop_long
         )
-        logger.info(f"Ride {ride.id} - Calculated distance using haversine: {ride.distance_km:.2f} km")
+        _set_if_changed(ride, "distance_km", distance_km)
+        logger.info("Ride %s - Calculated distance using haversine: %.2f km", rid, distance_km)
     else:
-        logger.info(f"Ride {ride.id} - Using existing distance: {ride.distance_km:.2f} km")
+        logger.info("Ride %s - Using existing distance: %.2f km", rid, distance_km)
     
     # Calculate duration and waiting time
     duration_min = 0
     waiting_min = 0
     
-    if ride.start_ride_at and ride.end_ride_at:
-        duration_min = (ride.end_ride_at - ride.start_ride_at).total_seconds() / 60
-        logger.info(f"Ride {ride.id} - Ride duration: {duration_min:.2f} minutes")
+    if start and end:
+        duration_min = (end - start).total_seconds() / 60
+        logger.info("Ride %s - Ride duration: %.2f minutes", rid, duration_min)
     else:
-        logger.warning(f"Ride {ride.id} - Cannot calculate duration: start_ride_at={ride.start_ride_at}, end_ride_at={ride.end_ride_at}")
+        logger.warning("Ride %s - Cannot calculate duration: start_ride_at=%s, end_ride_at=%s",
+                       rid, start, end)
     
-    if ride.driver_at_location_at and ride.start_ride_at:
-        waiting_min = (ride.start_ride_at - ride.driver_at_location_at).total_seconds() / 60
-        logger.info(f"Ride {ride.id} - Waiting time: {waiting_min:.2f} minutes")
+    if arrived and start:
+        waiting_min = (start - arrived).total_seconds() / 60
+        logger.info("Ride %s - Waiting time: %.2f minutes", rid, waiting_min)
     else:
-        logger.warning(f"Ride {ride.id} - Cannot calculate waiting time: driver_at_location_at={ride.driver_at_location_at}, start_ride_at={ride.start_ride_at}")
+        logger.warning("Ride %s - Cannot calculate waiting time: driver_at_location_at=%s, start_ride_at=%s",
+                       rid, arrived, start)
+
+    # Calculate fare components in whole cents; each is rounded once and the total is exact
+    base_cents = to_cents(base_fare)
+    distance_cents = round(distance_km * rate_per_km * 100)
+    time_cents = round(duration_min * rate_per_minute * 100)
+    waiting_cents = round(waiting_min * waiting_charge_per_minute * 100)
+    fare_cents = base_cents + distance_cents + time_cents + waiting_cents
 
-    # Calculate fare components
-    base_fare_component = base_fare
-    distance_fare_component = ride.distance_km * rate_per_km
-    time_fare_component = duration_min * rate_per_minute
-    waiting_fare_component = waiting_min * waiting_charge_per_minute
+    base_fare_component = base_cents / 100
+    distance_fare_component = distance_cents / 100
+    time_fare_component = time_cents / 100
+    waiting_fare_component = waiting_cents / 100
     
     # Store fare components for logging
-    ride.base_fare = base_fare_component
-    ride.distance_fare = distance_fare_component
-    ride.time_fare = time_fare_component
-    ride.waiting_fare = waiting_fare_component
+    _set_if_changed(ride, "base_fare", base_fare_component)
+    _set_if_changed(ride, "distance_fare", distance_fare_component)
+    _set_if_changed(ride, "time_fare", time_fare_component)
+    _set_if_changed(ride, "waiting_fare", waiting_fare_component)
     
     # Calculate total fare using the formula
-    fare = base_fare_component + distance_fare_component + time_fare_component + waiting_fare_component
+    fare = fare_cents / 100
 
-    # Log fare breakdown
-    logger.info(f"Ride {ride.id} - Fare breakdown:")
-    logger.info(f"  Base fare: ${base_fare_component:.2f}")
-    logger.info(f"  Distance fare: ${distance_fare_component:.2f} ({ride.distance_km:.2f} km × ${rate_per_km}/km)")
-    logger.info(f"  Time fare: ${time_fare_component:.2f} ({duration_min:.2f} min × ${rate_per_minute}/min)")
-    logger.info(f"  Waiting fare: ${waiting_fare_component:.2f} ({waiting_min:.2f} min × ${waiting_charge_per_minute}/min)")
-    logger.info(f"  Total fare: ${fare:.2f}")
+    # Log fare breakdown (skipped entirely when INFO is off)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Ride %s - Fare breakdown:", rid)
+        logger.info("  Base fare: $%.2f", base_fare_component)
+        logger.info("  Distance fare: $%.2f (%.2f km × $%s/km)", distance_fare_component, distance_km, rate_per_km)
+        logger.info("  Time fare: $%.2f (%.2f min × $%s/min)", time_fare_component, duration_min, rate_per_minute)
+        logger.info("  Waiting fare: $%.2f (%.2f min × $%s/min)", waiting_fare_component, waiting_min, waiting_charge_per_minute)
+        logger.info("  Total fare: $%.2f", fare)
 
-    ride.fare = round(fare, 2)
-    db.session.commit()
-    logger.info(f"===== FARE CALCULATION COMPLETED FOR RIDE {ride.id} =====\n")
+    _set_if_changed(ride, "fare", fare)
+    if commit:
+        db.session.commit()
+    logger.info("===== FARE CALCULATION COMPLETED FOR RIDE %s =====\n", rid)
     return fare
+
+
+def recompute_fares(*criteria):
+    """Recalculate and store fares in bulk for rides matching criteria (default: completed rides)"""
+    criteria = criteria or (Ride.status == "end_ride",)
+    rows = db.session.execute(select(
+        Ride.id, Ride.pickup_lat, Ride.pickup_long, Ride.drop_lat, Ride.drop_long,
+        Ride.driver_at_location_at, Ride.start_ride_at, Ride.end_ride_at, Ride.distance_km
+    ).where(*criteria)).all()
+    if not rows:
+        return 0
+    ids, pickup_lat, pickup_long, drop_lat, drop_long, at_location, start, end, distance = zip(*rows)
+
+    rates = get_rates(DEFAULT_RATES.keys(), DEFAULT_RATES)
+
+    # Rides without a stored distance get the great circle distance, computed in one pass
+    distance_km = np.array(distance, dtype=np.float64)  # NULL becomes NaN
+    has_distance = np.isfinite(distance_km) & (distance_km > 0)
+    coords = [np.array(c, dtype=np.float64) for c in (pickup_lat, pickup_long, drop_lat, drop_long)]
+    # The kernel is compiled with fastmath and assumes finite inputs, so rides with
+    # NULL coordinates must be kept away from it rather than checked afterwards
+    has_coords = np.logical_and.reduce([np.isfinite(c) for c in coords])
+    to_compute = ~has_distance & has_coords
+    if to_compute.any():
+        points = tuple(c[to_compute] for c in coords)
+        distance_km[to_compute] = haversine_par(*points, np.empty_like(points[0]))
+    # Rides with neither a stored distance nor coordinates can't be priced; skip them
+    # rather than store garbage
+    priced = has_distance | to_compute
+    if not priced.all():
+        skipped = [ride_id for ride_id, ok in zip(ids, priced.tolist()) if not ok]
+        logger.warning("Skipping %d rides without a usable distance: %s", len(skipped), skipped)
+        distance_km = np.where(priced, distance_km, 0.0)
+    # Durations as microsecond datetime64 differences, matching total_seconds();
+    # NULL timestamps become NaT and count as 0 minutes
+    start = np.array(start, dtype='datetime64[us]')
+    end = np.array(end, dtype='datetime64[us]')
+    at_location = np.array(at_location, dtype='datetime64[us]')
+    duration_min = np.where(np.isnat(start) | np.isnat(end), 0.0,
+                            (end - start).astype(np.int64) / 60e6)
+    waiting_min = np.where(np.isnat(at_location) | np.isnat(start), 0.0,
+                           (start - at_location).astype(np.int64) / 60e6)
+
+    # Same integer-cent arithmetic as calculate_fare
+    fare_cents = (
+        to_cents(rates["base_fare"])
+        + np.rint(distance_km * rates["rate_per_km"] * 100).astype(np.int64)
+        + np.rint(duration_min * rates["rate_per_minute"] * 100).astype(np.int64)
+        + np.rint(waiting_min * rates["waiting_charge_per_minute"] * 100).astype(np.int64)
+    )
+    fares = fare_cents / 100
+
+    if priced.any():
+        rides_table = Ride.__table__
+        db.session.execute(
+            update(rides_table).where(rides_table.c.id == bindparam("rid")).values(
+                distance_km=bindparam("dist"),
+                fare=bindparam("fare")
+            ),
+            [{"rid": ride_id, "dist": dist, "fare": fare}
+             for ride_id, dist, fare, ok in zip(ids, distance_km.tolist(), fares.tolist(), priced.tolist()) if ok]
+        )
+    db.session.commit()
+    count = int(np.count_nonzero(priced))
+    logger.info("Recomputed fares for %d rides", count)
+    return count